@@ -10,33 +10,60 @@ from megatron.core import mpu
 
 
 # TODO: use functions from megatron/p2p
-def recv_from_prev_pipeline_rank_(recv_buffer=None):
+def send_recv_pipeline_ranks_async(tensor_send_next=None, tensor_recv_prev=None, pp_group=None):
+    """Post a non-blocking send to the next pipeline stage and a non-blocking
+    receive from the previous pipeline stage as a single group, so that NCCL
+    can run both in one kernel. Either side may be None, and ops that do not
+    apply to this stage are dropped. `pp_group` defaults to the pipeline model
+    parallel group. Returns the requests that have to be waited on (see
+    `wait_on_pipeline_requests`) before the buffers are reused."""
+    if pp_group is None:
+        pp_group = parallel_state.get_pipeline_model_parallel_group()
+    ops = []
+    if tensor_send_next is not None and not mpu.is_pipeline_last_stage():
+        ops.append(torch.distributed.P2POp(
+            torch.distributed.isend, tensor_send_next,
+            mpu.get_pipeline_model_parallel_next_rank(), group=pp_group))
+    if tensor_recv_prev is not None and not mpu.is_pipeline_first_stage():
+        ops.append(torch.distributed.P2POp(
+            torch.distributed.irecv, tensor_recv_prev,
+            mpu.get_pipeline_model_parallel_prev_rank(), group=pp_group))
+    if not ops:
+        return []
+    return torch.distributed.batch_isend_irecv(ops)
+
+
+def wait_on_pipeline_requests(reqs):
+    """Wait for outstanding point-to-point requests to complete."""
+    if not reqs:
+        return
+    for req in reqs:
+        req.wait()
+    # To protect against race condition when using batch_isend_irecv().
+    torch.cuda.synchronize()
+
+
+def send_recv_pipeline_ranks_(tensor_send_next=None, tensor_recv_prev=None, pp_group=None):
+    """Blocking version of `send_recv_pipeline_ranks_async`: both directions
+    are issued as one group and synchronized once. The receive buffer is
+    updated inplace."""
+    wait_on_pipeline_requests(send_recv_pipeline_ranks_async(
+        tensor_send_next=tensor_send_next, tensor_recv_prev=tensor_recv_prev, pp_group=pp_group))
+
+
+def recv_from_prev_pipeline_rank_(recv_buffer=None, pp_group=None):
     """Receive from previous pipeline stage and update the
     input buffer inplace."""
     if not mpu.is_pipeline_first_stage():
         assert recv_buffer is not None
-        recv_prev_op = torch.distributed.P2POp(
-            torch.distributed.irecv, recv_buffer,
-            mpu.get_pipeline_model_parallel_prev_rank(), group=parallel_state.get_pipeline_model_parallel_group())
-        reqs = torch.distributed.batch_isend_irecv([recv_prev_op])
-        for req in reqs:
-            req.wait()
-        # To protect against race condition when using batch_isend_irecv().
-        torch.cuda.synchronize()
+        send_recv_pipeline_ranks_(tensor_recv_prev=recv_buffer, pp_group=pp_group)
 
-# TODO: use functions from megatron/p2p
-def send_to_next_pipeline_rank(tensor=None):
+
+def send_to_next_pipeline_rank(tensor=None, pp_group=None):
     """Send output to the next pipeline stage."""
     if not mpu.is_pipeline_last_stage():
         assert tensor is not None
-        send_next_op = torch.distributed.P2POp(
-            torch.distributed.isend, tensor,
-            mpu.get_pipeline_model_parallel_next_rank(), group=parallel_state.get_pipeline_model_parallel_group())
-        reqs = torch.distributed.batch_isend_irecv([send_next_op])
-        for req in reqs:
-            req.wait()
-        # To protect against race condition when using batch_isend_irecv().
-        torch.cuda.synchronize()
+        send_recv_pipeline_ranks_(tensor_send_next=tensor, pp_group=pp_group)
 
 
 
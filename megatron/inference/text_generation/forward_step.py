@@ -2,6 +2,9 @@
 
 """Forward step utilities."""
 
+import contextlib
+import math
+import os
 from collections.abc import Iterable
 
 import torch
@@ -12,7 +15,62 @@ from megatron.core.inference.contexts import BaseInferenceContext
 from megatron.core.transformer.module import MegatronModule
 from megatron.training import get_args
 
-from .communication import recv_from_prev_pipeline_rank_, send_to_next_pipeline_rank
+from .communication import (
+    recv_from_prev_pipeline_rank_,
+    send_recv_pipeline_ranks_async,
+    send_to_next_pipeline_rank,
+)
+
+# Number of pipelined forward steps that are timed before the number of
+# micro batches is chosen from the measured latencies.
+_MB_PROFILE_STEPS = 3
+# Once the latency model is built, one in this many pipelined forward steps
+# is still timed so that the model is re-fitted as shapes change.
+_MB_PROFILE_INTERVAL = 16
+# If no latency model can be fitted after this many timed pipelined forward
+# steps, e.g. because fixed length prompts at or above the threshold always
+# give micro batches of one sample, profiling stops for good and the
+# threshold split is used.
+_MB_MAX_PROFILE_STEPS = 32
+
+# Set MEGATRON_NVTX=1 to annotate the receives, sends, forward passes and
+# logits copies with NVTX ranges, e.g. to see pipeline bubbles in Nsight
+# Systems. The ranges are no-ops otherwise.
+_NVTX = os.environ.get("MEGATRON_NVTX", "0") == "1"
+
+
+def _range(name, micro_batch_index=None):
+    """NVTX range `name`, suffixed with the micro batch index if given."""
+    if not _NVTX:
+        return contextlib.nullcontext()
+    if micro_batch_index is not None:
+        name = f"{name}_mb{micro_batch_index}"
+    return torch.cuda.nvtx.range(name)
+
+
+class _LatencyProfile:
+    """Micro batch latency profile of one forward step class. It outlives the
+    forward steps, since a new one is created for every generation request."""
+
+    def __init__(self):
+        # (micro batch size, sequence length) -> [total forward ms, count]
+        self.mb_profile = {}
+        # (micro batch size, sequence length) -> [total receive wait ms, count]
+        # The wait runs from when the receive can be posted until the micro
+        # batch has arrived. It includes the compute of the upstream stages,
+        # so it is the interval at which micro batches arrive rather than a
+        # transfer time.
+        self.recv_profile = {}
+        self.num_profiled_steps = 0
+        self.num_pipelined_steps = 0
+        # Number of latency model syncs. They run once per generation request
+        # on every rank of the model parallel group, so this and everything
+        # derived from the reduction below is the same on all of them.
+        self.num_syncs = 0
+        # (fixed ms, forward ms per token, receive wait ms per token) once fitted.
+        self.latency_model = None
+        # Whether profiling stopped without a latency model.
+        self.stopped = False
 
 
 class ForwardStep:
@@ -20,6 +78,12 @@ class ForwardStep:
     We use a class here to hide the inference parameters
     from the outside caller."""
 
+    # Forward step class -> _LatencyProfile. Subclasses such as multimodal
+    # forward steps run different models, so they do not share a profile.
+    _latency_profiles = {}
+    # Whether the `inference_params` deprecation warning was already issued.
+    _warned_params = False
+
     def __init__(
         self,
         model: MegatronModule,
@@ -39,78 +103,136 @@ class ForwardStep:
         # Threshold for whether we split up the batch for pipelining.
         self.pipelining_batch_x_seqlen = \
             args.inference_batch_times_seqlen_threshold
+        # Whether batches may be split up for pipelining at all. This is
+        # fixed for the lifetime of the forward step, so decide it once.
+        self._pipelining_enabled = (
+            self.pipeline_size_larger_than_one and self.pipelining_batch_x_seqlen != -1)
+        # Values used on every forward step that do not change for the
+        # lifetime of the forward step.
+        self._args = args
+        self._is_first = mpu.is_pipeline_first_stage()
+        self._is_last = mpu.is_pipeline_last_stage()
+        self._recv_dtype = _get_recv_buffer_dtype(args)
+        self._hidden_size = args.hidden_size
+        self._vocab = args.padded_vocab_size
+        self._device = torch.cuda.current_device()
+        self._pp_group = mpu.get_pipeline_model_parallel_group()
+        # Stream and event pool used to overlap communication with compute
+        # when the batch is split up for pipelining.
+        self._comm_stream = torch.cuda.Stream() if self._pipelining_enabled else None
+        self._events = []
+        self._profile = ForwardStep._latency_profiles.setdefault(type(self), _LatencyProfile())
+        if self._pipelining_enabled:
+            self._sync_latency_model()
+
+    def _sync_latency_model(self):
+        """Re-fit the latency model to the profile collected so far and
+        reduce it across the model parallel ranks. Every rank builds a forward
+        step for each generation request, so the reduction is issued here
+        rather than on the pipelined path, which ranks may take a different
+        number of times (e.g. encoder only stages without images)."""
+        profile = self._profile
+        if profile.stopped:
+            return
+        latency_model = None
+        if profile.num_profiled_steps >= _MB_PROFILE_STEPS:
+            latency_model = _fit_latency_model(profile.mb_profile, profile.recv_profile)
+        profile.latency_model, num_profiled_steps = _reduce_latency_model(
+            latency_model, profile.num_profiled_steps)
+        profile.num_syncs += 1
+        if profile.latency_model is None and num_profiled_steps >= _MB_MAX_PROFILE_STEPS:
+            profile.stopped = True
+
+    @staticmethod
+    def _warn_inference_params():
+        if not ForwardStep._warned_params:
+            warnings.warn(
+                "`inference_params` renamed to `inference_context`, and will be removed in `megatron-core` 0.13.",
+                stacklevel=3)
+            ForwardStep._warned_params = True
 
     @property
     def inference_params(self):
-        warnings.warn("`inference_params` renamed to `inference_context`, and will be removed in `megatron-core` 0.13.")
+        self._warn_inference_params()
         return self.inference_context
 
     @inference_params.setter
     def inference_params(self, value):
-        warnings.warn("`inference_params` renamed to `inference_context`, and will be removed in `megatron-core` 0.13.")
+        self._warn_inference_params()
         self.inference_context = value
 
     def _forward(self, tokens, position_ids, attention_mask):
         return self.model(tokens, position_ids, attention_mask, inference_context=self.inference_context)
 
-    def __call__(self, tokens, position_ids, attention_mask, recv_buffer_seq_length=None):
+    def __call__(self, tokens, position_ids, attention_mask, recv_buffer_seq_length=None,
+                 sample_fn=None):
         """Invocation of the forward methods. Note that self.inference_context
-        is being modified by the forward step."""
+        is being modified by the forward step.
+
+        If `sample_fn` is given, it is applied on the last stage to the [b, s, v]
+        logits of every micro batch, and its outputs concatenated along the batch
+        dimension are returned instead of the logits. This avoids materializing
+        the full logits when e.g. only top-k or argmax results are needed."""
         # Pipelining case.
         # This runs only if current_batch_x_seqlen > args.inference_batch_times_seqlen_threshold
         # and requires setting args.pipeline_model_parallel > 1. The batch will be split into
         # smaller microbatches to be pipelined through the stages.
-        if self.pipeline_size_larger_than_one and self.pipelining_batch_x_seqlen != -1:
+        if self._pipelining_enabled:
             seq_len = tokens.size(1) if recv_buffer_seq_length is None else recv_buffer_seq_length
             current_batch_x_seqlen = tokens.size(0) * seq_len
             if current_batch_x_seqlen >= self.pipelining_batch_x_seqlen:
-                micro_batch_size = \
-                    max(1, self.pipelining_batch_x_seqlen // seq_len)
+                micro_batch_size = self._get_micro_batch_size(tokens.size(0), seq_len)
                 return self._with_pipelining_forward_step(tokens,
                                                           position_ids,
                                                           attention_mask,
                                                           micro_batch_size,
-                                                          recv_buffer_seq_length=recv_buffer_seq_length)
+                                                          recv_buffer_seq_length=recv_buffer_seq_length,
+                                                          sample_fn=sample_fn)
 
         recv_buffer = None
         if recv_buffer_seq_length is not None:
-            recv_buffer = _allocate_recv_buffer(tokens.size(0), recv_buffer_seq_length)
+            recv_buffer = self._allocate_recv_buffer(tokens.size(0), recv_buffer_seq_length)
 
         return self._no_pipelining_forward_step(tokens,
                                                 position_ids,
                                                 attention_mask,
-                                                recv_buffer=recv_buffer)
+                                                recv_buffer=recv_buffer,
+                                                sample_fn=sample_fn)
 
 
-    def _forward_step_helper(self, tokens, position_ids, attention_mask, recv_buffer=None):
+    def _forward_step_helper(self, tokens, position_ids, attention_mask, recv_buffer=None,
+                             communicate=True, micro_batch_index=None):
         """Single forward step. Update the allocate memory flag so
-        only the first time the memory is allocated."""
-        batch_size = tokens.size(0)
-        sequence_length = tokens.size(1)
-
-        if recv_buffer is None:
-            recv_buffer = _allocate_recv_buffer(batch_size, sequence_length)
-
-        # Receive from previous stage.
-        if recv_buffer is not None and torch.numel(recv_buffer) > 0:
-            recv_from_prev_pipeline_rank_(recv_buffer)
+        only the first time the memory is allocated. If `communicate` is
+        False, the caller has already received into `recv_buffer` and is
+        responsible for sending the output to the next stage.
+        `micro_batch_index` only names the NVTX ranges."""
+        # Receive from previous stage. The first stage has nothing to receive.
+        if not self._is_first:
+            if recv_buffer is None:
+                recv_buffer = self._allocate_recv_buffer(tokens.size(0), tokens.size(1))
+            if communicate and recv_buffer.numel() > 0:
+                with _range("recv"):
+                    recv_from_prev_pipeline_rank_(recv_buffer, pp_group=self._pp_group)
+            self.model.set_input_tensor(recv_buffer)
 
         # Forward pass through the model.
-        if not mpu.is_pipeline_first_stage():
-            self.model.set_input_tensor(recv_buffer)
-        output_tensor = self._forward(tokens, position_ids, attention_mask)
-        if isinstance(output_tensor, tuple):
+        with _range("forward", micro_batch_index):
+            output_tensor = self._forward(tokens, position_ids, attention_mask)
+        if type(output_tensor) is tuple:
             output_tensor = output_tensor[0]
 
         # Send output to the next stage.
-        send_to_next_pipeline_rank(output_tensor)
+        if communicate:
+            with _range("send"):
+                send_to_next_pipeline_rank(output_tensor, pp_group=self._pp_group)
 
         return output_tensor
 
 
 
     def _no_pipelining_forward_step(self, tokens, position_ids, attention_mask,
-                                    recv_buffer=None):
+                                    recv_buffer=None, sample_fn=None):
         """If recv_buffer is none, we will allocate one on the fly."""
         # Run a simple forward pass.
         output_tensor = self._forward_step_helper(tokens, position_ids,
@@ -119,62 +241,300 @@ class ForwardStep:
         self.inference_context.sequence_len_offset += tokens.size(1)
 
         logits = None
-        if mpu.is_pipeline_last_stage():
-            logits = output_tensor
+        if self._is_last:
+            logits = output_tensor if sample_fn is None else sample_fn(output_tensor)
 
         return logits
 
 
-    def _with_pipelining_forward_step(self, tokens, position_ids, attention_mask, micro_batch_size, recv_buffer_seq_length=None):
+    def _with_pipelining_forward_step(self, tokens, position_ids, attention_mask, micro_batch_size, recv_buffer_seq_length=None,
+                                      sample_fn=None):
         """No interleaving is supported."""
         batch_size = tokens.size(0)
         sequence_length = tokens.size(1) if recv_buffer_seq_length is None else recv_buffer_seq_length
 
         # Divide the batch dimension into micro batches.
-        num_micro_batches, last_chunk = divmod(batch_size,
-                                            micro_batch_size)
-        if last_chunk > 0:
-            num_micro_batches += 1
-
-        # Preallocate memory for output logits.
+        num_micro_batches = (batch_size + micro_batch_size - 1) // micro_batch_size
+
+        # Memory for output logits is allocated with the first micro batch,
+        # in the dtype of the model output (float32 after `Float16Module`),
+        # so that pipelined logits match the non-pipelined ones. A single
+        # micro batch, e.g. a single prompt above the threshold, returns the
+        # output as is without a copy. With a `sample_fn` only its per micro
+        # batch results are kept.
         logits = None
-        if mpu.is_pipeline_last_stage():
-            args = get_args()
-            logits = torch.empty(
-                (batch_size, sequence_length, args.padded_vocab_size),
-                dtype=torch.float32, device=torch.cuda.current_device())
-
-        # Preallocate recv buffer.
-        recv_buffer = _allocate_recv_buffer(micro_batch_size, sequence_length)
+        samples = []
+
+        # Time the micro batches until the latency model is built, and every
+        # so often afterwards to keep it up to date. Timing is local to this
+        # rank; the model is only reduced in `_sync_latency_model`.
+        latency_profile = self._profile
+        latency_profile.num_pipelined_steps += 1
+        if latency_profile.latency_model is None:
+            profile = not latency_profile.stopped
+        else:
+            profile = latency_profile.num_pipelined_steps % _MB_PROFILE_INTERVAL == 0
+        timings = []
+        recv_timings = {}
+
+        # Preallocate two recv buffers so that the receive of the next
+        # micro batch overlaps with the forward pass of the current one.
+        recv_buffers = [self._allocate_recv_buffer(micro_batch_size, sequence_length)
+                        for _ in range(2)]
+
+        # The callers pass column slices of the full token and position
+        # tensors; make them contiguous once here rather than letting the
+        # model copy every micro batch slice.
+        if not tokens.is_contiguous():
+            tokens = tokens.contiguous()
+        if not position_ids.is_contiguous():
+            position_ids = position_ids.contiguous()
+
+        # Slice among the batch dimenion and pick the recv buffer of each
+        # micro batch up front. The trailing None is the "next" buffer of
+        # the last micro batch.
+        tokens_chunks = torch.split(tokens, micro_batch_size, dim=0)
+        position_ids_chunks = torch.split(position_ids, micro_batch_size, dim=0)
+        micro_batch_recv_buffers = [
+            _shrink_recv_buffer(recv_buffers[micro_batch_index % 2], chunk.size(0))
+            for micro_batch_index, chunk in enumerate(tokens_chunks)
+        ] + [None]
+
+        # Communication runs on its own stream and is ordered against the
+        # forward passes with events instead of host synchronization:
+        # recv_done[i] is recorded once micro batch i has arrived and
+        # forward_done[i] once its forward pass is done.
+        events = self._get_events(2 * num_micro_batches)
+        recv_done = events[:num_micro_batches]
+        forward_done = events[num_micro_batches:]
+        compute_stream = torch.cuda.current_stream()
+        comm_stream = self._comm_stream
+        comm_stream.wait_stream(compute_stream)
+
+        inference_context = self.inference_context
+        is_last = self._is_last
+        pp_group = self._pp_group
+
+        def _has_recv(recv_index):
+            # Empty buffers (e.g. a stage that gets nothing for this batch)
+            # are not received into.
+            recv_tensor = micro_batch_recv_buffers[min(recv_index, num_micro_batches)]
+            return recv_tensor is not None and recv_tensor.numel() > 0
+
+        def _communicate(send_tensor, recv_index):
+            """Send `send_tensor`, the output of micro batch `recv_index` - 2,
+            and receive micro batch `recv_index` as one group on the comm
+            stream."""
+            recv_tensor = micro_batch_recv_buffers[recv_index] if _has_recv(recv_index) else None
+            with contextlib.ExitStack() as ranges, torch.cuda.stream(comm_stream):
+                if send_tensor is not None and not is_last:
+                    ranges.enter_context(_range("send", recv_index - 2))
+                if recv_tensor is not None:
+                    ranges.enter_context(_range("recv", recv_index))
+                if recv_index > 1:
+                    # The output to send and the buffer the receive
+                    # overwrites are only ready after the previous forward.
+                    comm_stream.wait_event(forward_done[recv_index - 2])
+                if profile and recv_tensor is not None:
+                    # Times the wait for the micro batch, which includes the
+                    # upstream compute, not just the transfer.
+                    recv_start = torch.cuda.Event(enable_timing=True)
+                    recv_start.record()
+                reqs = send_recv_pipeline_ranks_async(tensor_send_next=send_tensor,
+                                                      tensor_recv_prev=recv_tensor,
+                                                      pp_group=pp_group)
+                for req in reqs:
+                    req.wait()
+                if recv_tensor is not None:
+                    recv_done[recv_index].record()
+                    if profile:
+                        recv_end = torch.cuda.Event(enable_timing=True)
+                        recv_end.record()
+                        recv_timings[recv_index] = (recv_start, recv_end)
+            if send_tensor is not None and not is_last:
+                # The output is allocated on the compute stream.
+                send_tensor.record_stream(comm_stream)
+
+        _communicate(None, 0)
+        prev_output = None
+        start = 0
 
         for micro_batch_index in range(num_micro_batches):
-            # Slice among the batch dimenion.
-            start = micro_batch_index * micro_batch_size
-            end = min(start + micro_batch_size, batch_size)
-            this_micro_batch_size = end - start
-            tokens2use = tokens[start:end, ...]
-            position_ids2use = position_ids[start:end, ...]
+            tokens2use = tokens_chunks[micro_batch_index]
+            position_ids2use = position_ids_chunks[micro_batch_index]
+            this_micro_batch_size = tokens2use.size(0)
+            end = start + this_micro_batch_size
+            recv_buffer = micro_batch_recv_buffers[micro_batch_index]
+
+            # Send the previous output and start receiving the next micro
+            # batch as one group, so that both overlap with the forward pass
+            # below. Then wait (on the GPU) for this micro batch to arrive.
+            _communicate(prev_output, micro_batch_index + 1)
+            if _has_recv(micro_batch_index):
+                compute_stream.wait_event(recv_done[micro_batch_index])
 
             # Run a simple forward pass.
-            if this_micro_batch_size != micro_batch_size:
-                recv_buffer = None
-            output = self._forward_step_helper(tokens2use, position_ids2use, attention_mask, recv_buffer=recv_buffer)
+            if profile:
+                start_event = torch.cuda.Event(enable_timing=True)
+                end_event = torch.cuda.Event(enable_timing=True)
+                start_event.record()
+            output = self._forward_step_helper(tokens2use, position_ids2use, attention_mask,
+                                               recv_buffer=recv_buffer, communicate=False,
+                                               micro_batch_index=micro_batch_index)
+            forward_done[micro_batch_index].record()
+            if profile:
+                end_event.record()
+                timings.append((this_micro_batch_size, start_event, end_event))
 
             # Adjust the batch size offset to account for the micro-batch.
-            self.inference_context.batch_size_offset += this_micro_batch_size
+            inference_context.batch_size_offset += this_micro_batch_size
 
             # Copy logits.
-            if mpu.is_pipeline_last_stage():
-                logits[start:end, ...] = output
+            if is_last:
+                if sample_fn is not None:
+                    samples.append(sample_fn(output))
+                elif num_micro_batches == 1:
+                    logits = output
+                else:
+                    if logits is None:
+                        logits = torch.empty(
+                            (batch_size, sequence_length, self._vocab),
+                            dtype=output.dtype,
+                            device=self._device)
+                    with _range("copy_logits", micro_batch_index):
+                        logits[start:end, ...] = output
+
+            prev_output = output
+            start = end
+
+        # Send the output of the last micro batch. Later work on the compute
+        # stream must not reuse the buffers before communication is done.
+        _communicate(prev_output, num_micro_batches + 1)
+        compute_stream.wait_stream(comm_stream)
+
+        if samples:
+            logits = torch.cat(samples, dim=0)
 
         # Once we are done with all the micro-batches, we can
         # adjust the sequence length offset.
-        self.inference_context.sequence_len_offset += tokens.size(1)
+        inference_context.sequence_len_offset += tokens.size(1)
         # and reset the batch size offset
-        self.inference_context.batch_size_offset = 0
+        inference_context.batch_size_offset = 0
+
+        if profile:
+            # The first receive also waits for the pipeline to fill up.
+            timings = [timing + (recv_timings.get(micro_batch_index),)
+                       if micro_batch_index > 0 else timing + (None,)
+                       for micro_batch_index, timing in enumerate(timings)]
+            self._record_profile(timings, sequence_length)
 
         return logits
 
+    def _get_events(self, num_events):
+        """Pool of reusable CUDA events with at least `num_events` entries."""
+        while len(self._events) < num_events:
+            self._events.append(torch.cuda.Event())
+        return self._events
+
+    def _record_profile(self, timings, sequence_length):
+        """Add the micro batch timings of one pipelined forward step to the
+        profile."""
+        torch.cuda.synchronize()
+        profile = self._profile
+        for micro_batch_size, start_event, end_event, recv_events in timings:
+            key = (micro_batch_size, sequence_length)
+            entry = profile.mb_profile.setdefault(key, [0.0, 0])
+            entry[0] += start_event.elapsed_time(end_event)
+            entry[1] += 1
+            if recv_events is not None:
+                entry = profile.recv_profile.setdefault(key, [0.0, 0])
+                entry[0] += recv_events[0].elapsed_time(recv_events[1])
+                entry[1] += 1
+        profile.num_profiled_steps += 1
+
+    def _get_micro_batch_size(self, batch_size, sequence_length):
+        """Micro batch size for pipelining a batch over the stages.
+
+        The threshold split keeps each micro batch below the batch x seqlen
+        threshold. Until the latency model is built, requests alternate
+        between the threshold split and half of it, so that the fit sees at
+        least two micro batch sizes; if profiling stops without a model the
+        threshold split is kept. Afterwards the number of micro batches N
+        minimizes the estimated time
+
+            N * max(compute, receive wait) + (pipeline size - 1) * compute
+
+        of a micro batch: a stage cannot run faster than its inputs arrive,
+        and the pipeline takes one compute per extra stage to fill up. N is
+        searched upwards from the pipeline size, or from the threshold split
+        if that has more micro batches, so micro batches never exceed the
+        threshold."""
+        max_micro_batch_size = max(1, self.pipelining_batch_x_seqlen // sequence_length)
+        latency_model = self._profile.latency_model
+        if latency_model is None:
+            if not self._profile.stopped and self._profile.num_syncs % 2 == 0:
+                return max(1, max_micro_batch_size // 2)
+            return max_micro_batch_size
+
+        fixed_ms, forward_ms_per_token, recv_wait_ms_per_token = latency_model
+        pipeline_size = self._args.pipeline_model_parallel_size
+        min_num_micro_batches = min(
+            batch_size, max(pipeline_size, math.ceil(batch_size / max_micro_batch_size)))
+        best_num_micro_batches, best_cost = None, None
+        for num_micro_batches in range(min_num_micro_batches, batch_size + 1):
+            micro_batch_tokens = math.ceil(batch_size / num_micro_batches) * sequence_length
+            compute_ms = fixed_ms + forward_ms_per_token * micro_batch_tokens
+            interval_ms = max(compute_ms, recv_wait_ms_per_token * micro_batch_tokens)
+            cost = num_micro_batches * interval_ms + (pipeline_size - 1) * compute_ms
+            if best_cost is None or cost < best_cost:
+                best_num_micro_batches, best_cost = num_micro_batches, cost
+        return math.ceil(batch_size / best_num_micro_batches)
+
+    def _allocate_recv_buffer(self, batch_size, sequence_length):
+        """Receive happens between the layers with size [s, b, h]."""
+        if self._is_first:
+            return None
+        return torch.empty((sequence_length, batch_size, self._hidden_size),
+                           dtype=self._recv_dtype, device=self._device)
+
+
+def _fit_latency_model(mb_profile, recv_profile):
+    """Fit forward latency = fixed + per_token * tokens to the profiled micro
+    batches, and the receive wait per token. Returns None unless at least two
+    micro batch token counts were profiled, since the fixed cost cannot be
+    told apart from the per token cost otherwise."""
+    tokens = [b * s for b, s in mb_profile]
+    if len(set(tokens)) < 2:
+        return None
+    forward_ms = [total / count for total, count in mb_profile.values()]
+    mean_tokens = sum(tokens) / len(tokens)
+    mean_ms = sum(forward_ms) / len(forward_ms)
+    per_token = sum((x - mean_tokens) * (y - mean_ms) for x, y in zip(tokens, forward_ms)) / \
+        sum((x - mean_tokens) ** 2 for x in tokens)
+    per_token = max(per_token, 0.0)
+    fixed = max(mean_ms - per_token * mean_tokens, 0.0)
+
+    recv_tokens = sum(b * s * count for (b, s), (_, count) in recv_profile.items())
+    recv_ms = sum(total for total, _ in recv_profile.values())
+    recv_wait_per_token = recv_ms / recv_tokens if recv_tokens > 0 else 0.0
+    return fixed, per_token, recv_wait_per_token
+
+
+def _reduce_latency_model(latency_model, num_profiled_steps):
+    """Reduce the latency models of the model parallel ranks so that all
+    stages choose the same micro batch size. Ranks without a model (None)
+    do not contribute; the model is None if no rank has one. Also returns
+    the largest number of profiled steps of any rank."""
+    values = [0.0, 0.0, 0.0, 0.0] if latency_model is None else [1.0, *latency_model]
+    reduced = torch.tensor([float(num_profiled_steps), *values], dtype=torch.float64,
+                           device=torch.cuda.current_device())
+    torch.distributed.all_reduce(reduced, op=torch.distributed.ReduceOp.MAX,
+                                 group=mpu.get_model_parallel_group())
+    num_profiled_steps, has_model, *latency_model = reduced.tolist()
+    if has_model == 0.0:
+        return None, int(num_profiled_steps)
+    return tuple(latency_model), int(num_profiled_steps)
+
 
 def _get_recv_buffer_dtype(args):
     """Receive happens between the layers."""
@@ -182,12 +542,12 @@ def _get_recv_buffer_dtype(args):
         return torch.float
     return args.params_dtype
 
-def _allocate_recv_buffer(batch_size, sequence_length):
-    """Receive happens between the layers with size [s, b, h]."""
-    if mpu.is_pipeline_first_stage():
-        return None
-    args = get_args()
-    recv_size = (sequence_length, batch_size, args.hidden_size)
-    return torch.empty(recv_size,
-                       dtype=_get_recv_buffer_dtype(args),
-                       device=torch.cuda.current_device())
+def _shrink_recv_buffer(recv_buffer, batch_size):
+    """View of the [s, b, h] `recv_buffer` for a smaller batch, e.g. the tail
+    micro batch. It uses the front of the buffer instead of narrowing the batch
+    dimension, since the receive needs a contiguous tensor."""
+    if recv_buffer is None or recv_buffer.size(1) == batch_size:
+        return recv_buffer
+    sequence_length, _, hidden_size = recv_buffer.shape
+    return recv_buffer.view(-1)[:sequence_length * batch_size * hidden_size].view(
+        sequence_length, batch_size, hidden_size)
@@ -90,7 +90,7 @@ def score_and_return_on_first_stage(model, tokens: torch.Tensor, lengths: torch.
         if mpu.is_pipeline_last_stage():
             # Always the last stage should have an output.
             assert logits is not None
-            log_probs = F.log_softmax(logits, dim=2).to(dtype=output_topk_log_probs.dtype)
+            log_probs = F.log_softmax(logits, dim=2, dtype=output_topk_log_probs.dtype)
 
             # Pick the tokens that we need to get the log
             # probabilities for. Note that next input token is
@@ -241,7 +241,8 @@ def generate_tokens_probs_and_return_on_first_stage(
                 assert logits is not None
 
                 # Sample.
-                last_token_logits = logits[:, -1, :]
+                # Logits may be in half precision; only upcast the last token.
+                last_token_logits = logits[:, -1, :].float()
                 new_sample = sample(last_token_logits,
                                     top_k=top_k,
                                     top_p=top_p,
@@ -260,7 +261,7 @@ def generate_tokens_probs_and_return_on_first_stage(
 
                 # Calculate the log probabilities.
                 if return_output_log_probs:
-                    log_probs = F.log_softmax(logits, dim=2)
+                    log_probs = F.log_softmax(logits, dim=2, dtype=torch.float32)
                     if return_output_log_probs:
                         # Pick the tokens that we need to get the log
                         # probabilities for. Note that next input token is
@@ -382,7 +383,7 @@ def beam_search_and_return_on_first_stage(model, forward_step, tokens, lengths,
                 if prevent_newline_after_colon:
                     logits[tokens2use[:, -1] == tokenizer.tokenize(':')[0], -1, tokenizer.tokenize('\n')[0]] = -1e10 # disable "\n" after ":"
                 vocab_size = logits.size(2)
-                log_probs = F.log_softmax(logits, dim=2)
+                log_probs = F.log_softmax(logits, dim=2, dtype=torch.float32)
                 new_scores = log_probs[:, -1, :] + scores
 
                 if context_length == prompt_length:  # if this is the first one
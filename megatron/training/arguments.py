@@ -1145,7 +1145,11 @@ def _add_inference_args(parser):
                        help='If (batch-size * sequence-length) is smaller than this threshold'
                        'then batches will not be split up for pipelining.'
                        'Requires setting --pipeline-model-parallel-size > 1.'
-                       'Setting this to -1 indicates that batch pipelining is not used.')
+                       'Setting this to -1 indicates that batch pipelining is not used. '
+                       'Micro batches never exceed this threshold; after the first '
+                       'pipelined steps are profiled, the number of micro batches, at '
+                       'least the pipeline size, is chosen from the measured forward '
+                       'latencies and receive waits.')
     group.add_argument('--max-tokens-to-oom',
                        type=int, default=12000,
                        help='Maximum number of tokens during inference'
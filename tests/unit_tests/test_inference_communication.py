@@ -0,0 +1,76 @@
+import unittest.mock
+
+import pytest
+import torch
+
+from megatron.inference.text_generation import communication
+
+
+@pytest.fixture
+def p2p():
+    """Mock the pipeline ranks and the point-to-point calls."""
+    with unittest.mock.patch.object(communication, 'mpu') as mpu, \
+            unittest.mock.patch.object(communication, 'parallel_state'), \
+            unittest.mock.patch('torch.distributed.P2POp') as p2p_op, \
+            unittest.mock.patch('torch.distributed.batch_isend_irecv') as batch_isend_irecv:
+        mpu.get_pipeline_model_parallel_next_rank.return_value = 2
+        mpu.get_pipeline_model_parallel_prev_rank.return_value = 0
+        p2p_op.side_effect = lambda op, tensor, peer, group=None: (op, tensor, peer, group)
+        batch_isend_irecv.side_effect = lambda ops: [unittest.mock.Mock() for _ in ops]
+        yield mpu, batch_isend_irecv
+
+
+def set_stage(mpu, is_first, is_last):
+    mpu.is_pipeline_first_stage.return_value = is_first
+    mpu.is_pipeline_last_stage.return_value = is_last
+
+
+def test_send_recv_middle_stage(p2p):
+    mpu, batch_isend_irecv = p2p
+    set_stage(mpu, is_first=False, is_last=False)
+    send, recv, group = torch.zeros(2), torch.zeros(2), object()
+    reqs = communication.send_recv_pipeline_ranks_async(
+        tensor_send_next=send, tensor_recv_prev=recv, pp_group=group)
+    assert len(reqs) == 2
+    # Both directions are posted as one group.
+    batch_isend_irecv.assert_called_once_with([
+        (torch.distributed.isend, send, 2, group),
+        (torch.distributed.irecv, recv, 0, group),
+    ])
+
+
+def test_send_dropped_on_last_stage(p2p):
+    mpu, batch_isend_irecv = p2p
+    set_stage(mpu, is_first=False, is_last=True)
+    recv = torch.zeros(2)
+    reqs = communication.send_recv_pipeline_ranks_async(
+        tensor_send_next=torch.zeros(2), tensor_recv_prev=recv, pp_group=None)
+    assert len(reqs) == 1
+    (ops,), _ = batch_isend_irecv.call_args
+    assert [(op, tensor) for op, tensor, _, _ in ops] == [(torch.distributed.irecv, recv)]
+
+
+def test_recv_dropped_on_first_stage(p2p):
+    mpu, batch_isend_irecv = p2p
+    set_stage(mpu, is_first=True, is_last=False)
+    send = torch.zeros(2)
+    reqs = communication.send_recv_pipeline_ranks_async(
+        tensor_send_next=send, tensor_recv_prev=torch.zeros(2))
+    assert len(reqs) == 1
+    (ops,), _ = batch_isend_irecv.call_args
+    assert [(op, tensor) for op, tensor, _, _ in ops] == [(torch.distributed.isend, send)]
+
+
+def test_no_ops_skip_batch_isend_irecv(p2p):
+    mpu, batch_isend_irecv = p2p
+    # Nothing to send from the last stage, nothing to receive on the first.
+    set_stage(mpu, is_first=True, is_last=True)
+    assert communication.send_recv_pipeline_ranks_async(
+        tensor_send_next=torch.zeros(2), tensor_recv_prev=torch.zeros(2)) == []
+    set_stage(mpu, is_first=False, is_last=False)
+    assert communication.send_recv_pipeline_ranks_async() == []
+    batch_isend_irecv.assert_not_called()
+    # Waiting on no requests does not synchronize.
+    with unittest.mock.patch('torch.cuda.synchronize') as synchronize:
+        communication.wait_on_pipeline_requests([])
+    synchronize.assert_not_called()
@@ -0,0 +1,237 @@
+import argparse
+import unittest.mock
+import warnings
+
+import pytest
+import torch
+
+from megatron.inference.text_generation import forward_step
+from megatron.inference.text_generation.forward_step import ForwardStep
+
+
+def make_args(pipeline_model_parallel_size=4, inference_batch_times_seqlen_threshold=512,
+              params_dtype=torch.float32):
+    return argparse.Namespace(
+        pipeline_model_parallel_size=pipeline_model_parallel_size,
+        inference_batch_times_seqlen_threshold=inference_batch_times_seqlen_threshold,
+        fp32_residual_connection=False,
+        params_dtype=params_dtype,
+        hidden_size=8,
+        padded_vocab_size=16,
+    )
+
+
+@pytest.fixture
+def forward_step_state(monkeypatch):
+    """Isolate the profile that is shared by all forward steps."""
+    monkeypatch.setattr(ForwardStep, '_latency_profiles', {})
+    monkeypatch.setattr(ForwardStep, '_warned_params', False)
+
+
+@pytest.fixture
+def make_forward_step(forward_step_state):
+    """Build forward steps on the CPU without initializing model parallelism."""
+    with unittest.mock.patch.object(forward_step, 'get_args') as get_args, \
+            unittest.mock.patch.object(forward_step, 'mpu') as mpu, \
+            unittest.mock.patch('torch.cuda.current_device', return_value='cpu'), \
+            unittest.mock.patch('torch.cuda.Stream'), \
+            unittest.mock.patch('torch.distributed.all_reduce'):
+
+        def _make_forward_step(args=None, is_first=True, is_last=True, model=None,
+                               forward_step_class=ForwardStep):
+            get_args.return_value = make_args() if args is None else args
+            mpu.is_pipeline_first_stage.return_value = is_first
+            mpu.is_pipeline_last_stage.return_value = is_last
+            inference_context = argparse.Namespace(sequence_len_offset=0, batch_size_offset=0)
+            return forward_step_class(unittest.mock.Mock() if model is None else model,
+                                      inference_context)
+
+        yield _make_forward_step
+
+
+@pytest.fixture
+def cpu_pipelining():
+    """Run the pipelined path of a single stage on the CPU."""
+    with unittest.mock.patch('torch.cuda.current_stream'), \
+            unittest.mock.patch('torch.cuda.stream'), \
+            unittest.mock.patch('torch.cuda.Event'), \
+            unittest.mock.patch.object(forward_step, 'send_recv_pipeline_ranks_async',
+                                       return_value=[]), \
+            unittest.mock.patch.object(ForwardStep, '_record_profile'):
+        yield
+
+
+def fake_model(vocab=16):
+    """Model whose float32 logits repeat the token ids over the vocabulary."""
+
+    def model(tokens, position_ids, attention_mask, inference_context=None):
+        return tokens[..., None].float().expand(-1, -1, vocab)
+
+    return unittest.mock.Mock(side_effect=model)
+
+
+def test_fit_latency_model_needs_two_token_counts():
+    # The same micro batch size every time, e.g. only prefill steps above the threshold.
+    mb_profile = {(8, 64): [30.0, 3]}
+    assert forward_step._fit_latency_model(mb_profile, {}) is None
+
+
+def test_fit_latency_model():
+    # 2 ms fixed, 0.01 ms per token.
+    mb_profile = {(8, 64): [2 * (2.0 + 0.01 * 512), 2], (4, 64): [2.0 + 0.01 * 256, 1]}
+    recv_profile = {(8, 64): [2 * 0.02 * 512, 2]}
+    fixed, per_token, recv_wait_per_token = forward_step._fit_latency_model(
+        mb_profile, recv_profile)
+    assert fixed == pytest.approx(2.0)
+    assert per_token == pytest.approx(0.01)
+    assert recv_wait_per_token == pytest.approx(0.02)
+
+
+def test_reduce_latency_model():
+    with unittest.mock.patch('torch.cuda.current_device', return_value='cpu'), \
+            unittest.mock.patch('torch.distributed.all_reduce') as all_reduce, \
+            unittest.mock.patch.object(forward_step, 'mpu'):
+        assert forward_step._reduce_latency_model(None, 2) == (None, 2)
+        # Ranks without a model still take part in the reduction.
+        assert all_reduce.call_count == 1
+        assert forward_step._reduce_latency_model((1.0, 2.0, 3.0), 4) == ((1.0, 2.0, 3.0), 4)
+
+
+def test_latency_model_synced_once_per_forward_step(make_forward_step):
+    with unittest.mock.patch.object(forward_step, '_reduce_latency_model',
+                                    return_value=(None, 0)) as reduce:
+        make_forward_step()
+        step = make_forward_step()
+        assert reduce.call_count == 2
+        assert step._profile.num_syncs == 2
+        # Without pipelining there is nothing to sync.
+        make_forward_step(args=make_args(pipeline_model_parallel_size=1))
+        assert reduce.call_count == 2
+
+
+def test_latency_profile_per_class(make_forward_step):
+    class OtherForwardStep(ForwardStep):
+        pass
+
+    step = make_forward_step()
+    other_step = make_forward_step(forward_step_class=OtherForwardStep)
+    assert other_step._profile is not step._profile
+    assert make_forward_step()._profile is step._profile
+
+
+def test_profiling_stops_without_latency_model(make_forward_step):
+    step = make_forward_step()
+    # Every micro batch has the same size, so no model can be fitted.
+    step._profile.mb_profile = {(1, 1024): [10.0, forward_step._MB_MAX_PROFILE_STEPS]}
+    step._profile.num_profiled_steps = forward_step._MB_MAX_PROFILE_STEPS
+    with unittest.mock.patch.object(forward_step, '_reduce_latency_model',
+                                    side_effect=lambda model, steps: (model, steps)) as reduce:
+        make_forward_step()
+        assert step._profile.stopped
+        assert step._profile.latency_model is None
+        # No more syncs, and the threshold split is kept.
+        make_forward_step()
+        assert reduce.call_count == 1
+        assert step._get_micro_batch_size(32, 64) == 8
+        assert step._get_micro_batch_size(32, 64) == 8
+
+
+def test_get_micro_batch_size_while_profiling(make_forward_step):
+    step = make_forward_step()
+    # The threshold split and half of it alternate across requests.
+    assert step._profile.num_syncs == 1
+    assert step._get_micro_batch_size(32, 64) == 8
+    make_forward_step()
+    assert step._get_micro_batch_size(32, 64) == 4
+
+
+def test_get_micro_batch_size(make_forward_step):
+    step = make_forward_step()
+    # Per micro batch overhead dominates: as few micro batches as the
+    # threshold allows, 32 x 64 tokens in micro batches of at most 512.
+    step._profile.latency_model = (100.0, 1e-6, 0.0)
+    assert step._get_micro_batch_size(32, 64) == 8
+    # Pure per token cost favors as many micro batches as possible.
+    step._profile.latency_model = (0.0, 1.0, 0.0)
+    assert step._get_micro_batch_size(32, 64) == 1
+    # The search starts at the pipeline size, even with a small batch.
+    step._profile.latency_model = (100.0, 1e-6, 0.0)
+    assert step._get_micro_batch_size(8, 16) == 2
+    # Each micro batch takes at least as long as the upstream stages need to
+    # deliver it, which favors smaller micro batches.
+    step._profile.latency_model = (10.0, 1e-3, 0.0)
+    assert step._get_micro_batch_size(32, 64) == 8
+    step._profile.latency_model = (10.0, 1e-3, 0.1)
+    assert step._get_micro_batch_size(32, 64) == 2
+
+
+def test_shrink_recv_buffer():
+    recv_buffer = torch.zeros(3, 4, 8)
+    assert forward_step._shrink_recv_buffer(None, 2) is None
+    assert forward_step._shrink_recv_buffer(recv_buffer, 4) is recv_buffer
+    tail = forward_step._shrink_recv_buffer(recv_buffer, 1)
+    assert tail.shape == (3, 1, 8)
+    assert tail.is_contiguous()
+    # The tail uses the front of the slot.
+    assert tail.data_ptr() == recv_buffer.data_ptr()
+    tail.fill_(1.0)
+    assert recv_buffer.view(-1)[:3 * 1 * 8].eq(1.0).all()
+    assert recv_buffer.view(-1)[3 * 1 * 8:].eq(0.0).all()
+
+
+def test_pipelined_logits_keep_output_dtype(make_forward_step, cpu_pipelining):
+    # Float16Module returns float32 logits on the last stage.
+    step = make_forward_step(args=make_args(params_dtype=torch.bfloat16), model=fake_model())
+    tokens = torch.arange(5 * 3).view(5, 3)
+    position_ids = torch.arange(3).expand(5, -1)
+    logits = step._with_pipelining_forward_step(tokens, position_ids, None, micro_batch_size=2)
+    assert logits.dtype == torch.float32
+    assert torch.equal(logits, tokens[..., None].float().expand(-1, -1, 16))
+
+
+def test_pipelined_single_micro_batch_is_not_copied(make_forward_step, cpu_pipelining):
+    output = torch.zeros(1, 3, 16)
+    step = make_forward_step(model=unittest.mock.Mock(return_value=output))
+    # A single prompt above the threshold is a single micro batch.
+    assert step._get_micro_batch_size(1, 1024) == 1
+    logits = step._with_pipelining_forward_step(
+        torch.zeros(1, 3, dtype=torch.long), torch.arange(3).view(1, 3), None, micro_batch_size=1)
+    assert logits is output
+
+
+def test_inference_params_warns_once(make_forward_step):
+    step = make_forward_step()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        assert step.inference_params is step.inference_context
+        step.inference_params = step.inference_context
+        make_forward_step().inference_params
+    assert len(caught) == 1
+    assert 'inference_context' in str(caught[0].message)
+
+
+def test_pipelined_sample_fn(make_forward_step, cpu_pipelining):
+    batch_size, sequence_length = 5, 3
+    step = make_forward_step(model=fake_model())
+    tokens = torch.arange(batch_size * sequence_length).view(batch_size, sequence_length)
+    position_ids = torch.arange(sequence_length).expand(batch_size, -1)
+    # Three micro batches, the last one smaller.
+    samples = step._with_pipelining_forward_step(
+        tokens, position_ids, None, micro_batch_size=2,
+        sample_fn=lambda logits: logits[:, -1, 0])
+    assert step.model.call_count == 3
+    assert torch.equal(samples, tokens[:, -1].float())
+    assert step.inference_context.batch_size_offset == 0
+    assert step.inference_context.sequence_len_offset == sequence_length
+
+
+def test_pipelined_nvtx_ranges(make_forward_step, cpu_pipelining):
+    step = make_forward_step(is_first=False, model=fake_model())
+    tokens = torch.arange(4 * 3).view(4, 3)
+    position_ids = torch.arange(3).expand(4, -1)
+    with unittest.mock.patch.object(forward_step, '_NVTX', True), \
+            unittest.mock.patch('torch.cuda.nvtx.range') as nvtx_range:
+        step._with_pipelining_forward_step(tokens, position_ids, None, micro_batch_size=2)
+    names = [call.args[0] for call in nvtx_range.call_args_list]
+    assert names == ['recv_mb0', 'recv_mb1', 'forward_mb0', 'copy_logits_mb0',
+                     'forward_mb1', 'copy_logits_mb1']